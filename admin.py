@@ -0,0 +1,242 @@
+import os
+import json
+import time
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from firebase_admin import firestore
+
+from engine.tones import TONE_LABELS
+from engine.user_store import UserStore, init_firestore, split_batches
+
+# ---------------------------------------------------------
+# 一括メンテナンス CLI（user_health の全ユーザーが対象）
+#
+#   python admin.py migrate-tone --from 旧キー --to 新キー
+#     （--from が現役のキーのときは --allow-current が必要）
+#   python admin.py reset-guide
+#   python admin.py clear-answers
+#
+#   共通オプション：
+#     --dry-run      書き込まずに対象件数と変更例だけ表示
+#     --page-size    1 ページで読むドキュメント数
+#     --workers      バッチ書き込みの並列数
+#     --checkpoint   途中経過の保存先（中断しても続きから再開できる）
+#     --restart      チェックポイントを無視して最初からやり直す
+#
+#   書き込みは読み込んだときの update_time を前提条件にする。
+#   その間に bot 側で書き換えられたユーザーは上書きせず、「競合」として報告する。
+# ---------------------------------------------------------
+
+ANSWER_KEYS = ["Q1", "Q2", "Q3", "Q4"]
+
+
+# ---------------------------------------------------------
+# 操作の定義：ドキュメント → 書き込む差分（対象外なら None）
+# ---------------------------------------------------------
+
+def migrate_tone(args):
+    def _transform(data: dict):
+        if data.get("tone") == args.from_tone:
+            return {"tone": args.to_tone}
+        return None
+
+    return _transform
+
+
+def reset_guide(args):
+    def _transform(data: dict):
+        if data.get("seen_guide"):
+            return {"seen_guide": False}
+        return None
+
+    return _transform
+
+
+def clear_answers(args):
+    def _transform(data: dict):
+        keys = [k for k in ANSWER_KEYS if k in data]
+        if not keys:
+            return None
+        return {k: firestore.DELETE_FIELD for k in keys}
+
+    return _transform
+
+
+OPERATIONS = {
+    "migrate-tone": migrate_tone,
+    "reset-guide": reset_guide,
+    "clear-answers": clear_answers,
+}
+
+
+def describe_operation(args) -> str:
+    if args.command == "migrate-tone":
+        return f"migrate-tone:{args.from_tone}->{args.to_tone}"
+    return args.command
+
+
+def format_update(data: dict) -> str:
+    shown = {k: ("<削除>" if v is firestore.DELETE_FIELD else v) for k, v in data.items()}
+    return json.dumps(shown, ensure_ascii=False)
+
+
+# ---------------------------------------------------------
+# チェックポイント
+#   {"operation": ..., "last_doc_id": ..., "scanned": n, "updated": n, "conflicts": [uid, ...]}
+#   last_doc_id までのページは書き込み完了済み
+# ---------------------------------------------------------
+
+def load_checkpoint(path: str, operation: str):
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    if data.get("operation") != operation:
+        raise SystemExit(f"{path} は別の操作（{data.get('operation')}）のチェックポイントです。--restart で破棄できます。")
+    return data
+
+
+def save_checkpoint(path: str, data: dict):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+# ---------------------------------------------------------
+# 実行
+# ---------------------------------------------------------
+
+def run(args):
+    store = UserStore(init_firestore())
+    transform = OPERATIONS[args.command](args)
+    operation = describe_operation(args)
+    checkpoint_path = args.checkpoint or f".admin_checkpoint_{args.command}.json"
+
+    checkpoint = None
+    if not args.dry_run and not args.restart:
+        checkpoint = load_checkpoint(checkpoint_path, operation)
+
+    start_after = checkpoint["last_doc_id"] if checkpoint else None
+    scanned = checkpoint["scanned"] if checkpoint else 0
+    updated = checkpoint["updated"] if checkpoint else 0
+    conflicts = list(checkpoint.get("conflicts", [])) if checkpoint else []
+    if checkpoint:
+        print(f"チェックポイントから再開します（{start_after} の次から / 処理済み {scanned} 件）")
+
+    # inflight = [(ページ末尾の ID, [書き込み future], その時点の scanned, updated), ...]
+    inflight = deque()
+    samples = 0
+    resumed_from = scanned
+    started = time.monotonic()
+
+    def complete_pages(wait: bool):
+        """先頭から順に書き込み完了したページのぶんだけチェックポイントを進める"""
+        last = None
+        while inflight and (wait or all(f.done() for f in inflight[0][1])):
+            last_doc_id, futures, page_scanned, page_updated = inflight.popleft()
+            for f in futures:
+                # 失敗したらここで例外 → チェックポイントは直前のページのまま
+                for uid in f.result():
+                    print(f"  競合：{uid} は読み込み後に更新されていたため書き込みませんでした。")
+                    conflicts.append(uid)
+            last = (last_doc_id, page_scanned, page_updated)
+            wait = False
+        if last:
+            save_checkpoint(
+                checkpoint_path,
+                {
+                    "operation": operation,
+                    "last_doc_id": last[0],
+                    "scanned": last[1],
+                    "updated": last[2],
+                    "conflicts": conflicts,
+                },
+            )
+
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        for docs in store.iter_user_pages(args.page_size, start_after):
+            updates = []
+            for doc in docs:
+                data = transform(doc.to_dict() or {})
+                if data:
+                    updates.append((doc.id, data, doc.update_time))
+
+            scanned += len(docs)
+            updated += len(updates)
+
+            if args.dry_run:
+                for uid, data, _ in updates[: max(0, 10 - samples)]:
+                    print(f"  {uid}: {format_update(data)}")
+                    samples += 1
+            else:
+                futures = [pool.submit(store.commit_user_states, b) for b in split_batches(updates)]
+                inflight.append((docs[-1].id, futures, scanned, updated))
+
+                # 書き込み待ちが溜まりすぎないよう、古いページの完了を待つ
+                while len(inflight) > args.workers * 2:
+                    complete_pages(wait=True)
+                complete_pages(wait=False)
+
+            rate = (scanned - resumed_from) / max(time.monotonic() - started, 1e-6)
+            print(f"[{operation}] 読み込み {scanned} 件 / 対象 {updated} 件（{rate:.0f} 件/秒）")
+
+        while inflight:
+            complete_pages(wait=True)
+
+    if args.dry_run:
+        print(f"dry run：{updated} 件が更新対象です（書き込みはしていません）。")
+        return
+
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    print(f"完了：{updated - len(conflicts)} 件を更新しました。")
+    if conflicts:
+        print(f"競合 {len(conflicts)} 件は書き込んでいません。必要ならもう一度実行してください：{', '.join(conflicts)}")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="user_health の一括メンテナンス")
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--dry-run", action="store_true", help="書き込まずに対象だけ表示")
+    common.add_argument("--page-size", type=int, default=500, help="1 ページで読む件数")
+    common.add_argument("--workers", type=int, default=8, help="バッチ書き込みの並列数")
+    common.add_argument("--checkpoint", help="チェックポイントファイルのパス")
+    common.add_argument("--restart", action="store_true", help="チェックポイントを無視して最初から")
+
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("migrate-tone", parents=[common], help="tone キーを付け替える")
+    # --from は廃止済み（TONE_LABELS から消えた）キーも受け付ける
+    p.add_argument("--from", dest="from_tone", required=True, help="廃止するトーンキー")
+    p.add_argument("--to", dest="to_tone", required=True, choices=list(TONE_LABELS), help="新しいトーンキー")
+    p.add_argument(
+        "--allow-current",
+        action="store_true",
+        help="--from がまだ使われているトーンキーでも付け替える",
+    )
+
+    sub.add_parser("reset-guide", parents=[common], help="seen_guide をリセットして再びガイドを送る")
+    sub.add_parser("clear-answers", parents=[common], help="保存されている Q1〜Q4 の回答を消す")
+
+    return parser
+
+
+def parse_args(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command == "migrate-tone" and args.from_tone == args.to_tone:
+        parser.error("--from と --to が同じトーンキーです（何も変わりません）")
+    if args.command == "migrate-tone" and args.from_tone in TONE_LABELS and not args.allow_current:
+        parser.error(
+            f"--from {args.from_tone} はまだ使われているトーンキーです。"
+            "打ち間違いでなければ --allow-current を付けてください"
+        )
+    return args
+
+
+if __name__ == "__main__":
+    run(parse_args())
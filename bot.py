@@ -1,32 +1,27 @@
 import os
-import json
+import socket
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import discord
 from discord.ext import commands
-import firebase_admin
-from firebase_admin import credentials, firestore
 
-from engine.check_engine import generate_health_reply  # ← check_engine.py を利用
+from engine.check_engine import (  # ← check_engine.py を利用
+    analyze_answer,
+    generate_health_reply,
+    needs_ai_support,
+    prewarm_ai,
+    schedule_prewarm_ai,
+)
+from engine.instance_lease import FirestoreLeaseBackend, InstanceLease, LocalLeaseBackend
+from engine.tones import TONE_CHOICES, TONE_LABELS
+from engine.user_store import UserStateUnavailable, UserStore, count_pending, init_firestore
 
 # ---------------------------------------------------------
 # Firebase 接続（Render / ローカル両対応）
 # ---------------------------------------------------------
 
-firebase_json = os.getenv("FIREBASE_CREDENTIALS")
-
-if firebase_json:
-    try:
-        cred_dict = json.loads(firebase_json)
-        cred = credentials.Certificate(cred_dict)
-        firebase_admin.initialize_app(cred)
-        print("Firebase initialized from environment variable.")
-    except Exception as e:
-        print("Firebase JSON 読み込みエラー:", e)
-        raise
-else:
-    print("FIREBASE_CREDENTIALS が設定されていません。")
-    raise ValueError("Firebase credentials missing.")
-
-db = firestore.client()
+db = init_firestore()
 
 # ---------------------------------------------------------
 # Discord Bot 設定
@@ -38,28 +33,6 @@ intents = discord.Intents.default()
 intents.message_content = True
 bot = commands.Bot(command_prefix="!", intents=intents)
 
-# ---------------------------------------------------------
-# トーン（性格）
-# ---------------------------------------------------------
-
-TONE_CHOICES = {
-    "1": "gentle_female",
-    "2": "bright_girl",
-    "3": "cheerful_friend",  # 気さくで快活な女子
-    "4": "cool_girl",
-    "5": "strict_female",
-    "6": "calm_male",
-}
-
-TONE_LABELS = {
-    "gentle_female": "やさしい女性",
-    "bright_girl": "明るい女の子",
-    "cheerful_friend": "気さくで快活な女子",
-    "cool_girl": "クールな女性",
-    "strict_female": "厳しめの女性",
-    "calm_male": "落ち着いた男性",
-}
-
 # ---------------------------------------------------------
 # トーン別：質問テンプレ（Q1〜Q4）
 #   ・ユーザーが迷わないように「回答例」を1つだけ添える
@@ -108,36 +81,48 @@ QUESTION_TEMPLATES = {
 # Firestore 操作
 # ---------------------------------------------------------
 
-COLLECTION_NAME = "user_health"
+user_store = UserStore(db)
 
 
 def get_user_state(user_id: int):
-    ref = db.collection(COLLECTION_NAME).document(str(user_id))
-    doc = ref.get()
-    return doc.to_dict() if doc.exists else None
+    return user_store.get_user_state(user_id)
+
+
+def get_user_state_or_default(user_id: int):
+    """
+    Firestore が読めずキャッシュにも無いときは、初回案内・トーン選択を飛ばして
+    既定トーンで進めるための状態を返す（この状態は保存しない）
+    """
+    try:
+        return get_user_state(user_id)
+    except UserStateUnavailable:
+        return {"seen_guide": True, "tone": "gentle_female"}
 
 
 def set_user_state(user_id: int, data: dict):
-    ref = db.collection(COLLECTION_NAME).document(str(user_id))
-    ref.set(data, merge=True)
+    user_store.set_user_state(user_id, data)
 
 
 def add_log(user_id: int, tone: str, answers: dict, reply: str):
+    user_store.add_log(user_id, tone, answers, reply)
+
+
+REPLAY_INTERVAL = float(os.getenv("REPLAY_INTERVAL", "5"))
+
+
+async def replay_pending_loop():
     """
-    users/{uid}/logs/{auto_id} にログ保存（簡易版）
+    Firestore 障害中に溜まった書き込みを、イベントループを止めずに少しずつ再送する。
+    明け渡し中は drain_and_exit が出し切るので止まる。
     """
-    ref = db.collection(COLLECTION_NAME).document(str(user_id)).collection("logs")
-    ref.add(
-        {
-            "tone": tone,
-            "Q1": answers.get("Q1", ""),
-            "Q2": answers.get("Q2", ""),
-            "Q3": answers.get("Q3", ""),
-            "Q4": answers.get("Q4", ""),
-            "reply": reply,
-            "timestamp": firestore.SERVER_TIMESTAMP,
-        }
-    )
+    loop = asyncio.get_running_loop()
+    while not lease_state["draining"]:
+        await asyncio.sleep(REPLAY_INTERVAL)
+        if user_store.has_pending():
+            try:
+                await loop.run_in_executor(None, user_store.flush_pending)
+            except Exception as e:
+                print("保留書き込みの再送エラー:", e)
 
 # ---------------------------------------------------------
 # トリガー判定
@@ -172,10 +157,182 @@ GUIDE_TEXT = """\
 
 # user_session[user_id] = {
 #   "mode": "choose_tone" / "Q1" / "Q2" / "Q3" / "Q4",
-#   "after_tone_start_check": True/False
+#   "after_tone_start_check": True/False,
+#   "tone": "gentle_female" など（Q1〜Q4 中のみ）,
+#   "answers": {"Q1": "...", ...}（回答済みの分）,
+#   "features": {"Q1": {...}, ...}（回答が届いた時点で解析した結果）,
+#   "ai_prewarmed": True/False（AI の事前接続を済ませたか）
 # }
 user_session = {}
 
+
+def new_check_session(tone: str) -> dict:
+    return {"mode": "Q1", "tone": tone, "answers": {}, "features": {}, "ai_prewarmed": False}
+
+# ---------------------------------------------------------
+# 単一インスタンス運用（ローリングデプロイ時の引き継ぎ）
+#   ・リースを持っている間だけメッセージを処理する
+#   ・新インスタンスはウォームアップ後に旧インスタンスへ明け渡しを依頼し、
+#     旧インスタンスが保存した会話セッションを復元してから処理を始める
+#   ・引き継ぎ中に届いたメッセージは貯めておき、旧インスタンスが
+#     処理したメッセージ ID の集合に無いものだけを処理する
+#     （チャンネルをまたぐと ID の順に届くとは限らないので、最大値では判定しない）
+#   ・旧インスタンスは保留中の Firestore 書き込みを出し切ってから明け渡し、
+#     出し切れなかった分は引き継ぎ先が再送する
+# ---------------------------------------------------------
+
+INSTANCE_ID = os.getenv("INSTANCE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+LEASE_TTL = float(os.getenv("LEASE_TTL", "15"))
+LEASE_PENDING_LIMIT = int(os.getenv("LEASE_PENDING_LIMIT", "1000"))
+HANDLED_ID_LIMIT = int(os.getenv("HANDLED_ID_LIMIT", "5000"))
+# 明け渡し時に保留中の Firestore 書き込みを出し切るまで待つ上限（残りは引き継ぎ先へ）
+DRAIN_FLUSH_SECONDS = float(os.getenv("DRAIN_FLUSH_SECONDS", "10"))
+
+if os.getenv("LEASE_BACKEND", "firestore") == "local":
+    lease_backend = LocalLeaseBackend()
+else:
+    lease_backend = FirestoreLeaseBackend(db)
+
+# リース操作は専用スレッドで行う（再送や AI の事前接続が詰まっていても更新できるように）
+lease_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="lease")
+
+# lease_state = {
+#   "takeover_started": on_ready で引き継ぎを始めたか,
+#   "starting": 引き継ぎ中（届いたメッセージは pending に貯める）,
+#   "draining": 明け渡し中・終了中（新しいメッセージは処理しない）,
+#   "in_flight": 処理中のメッセージ数,
+#   "handled_ids": 処理を始めたメッセージ ID（直近 HANDLED_ID_LIMIT 件、引き継ぎ先に渡す）,
+#   "pending": 引き継ぎ中に届いたメッセージ（LEASE_PENDING_LIMIT 件まで）
+# }
+lease_state = {
+    "takeover_started": False,
+    "starting": True,
+    "draining": False,
+    "in_flight": 0,
+    "handled_ids": deque(maxlen=HANDLED_ID_LIMIT),
+    "pending": [],
+}
+
+
+def run_on_bot_loop(coro_fn):
+    """リースの変更通知（別スレッド）から bot のイベントループへ処理を渡す"""
+    bot.loop.call_soon_threadsafe(lambda: asyncio.ensure_future(coro_fn()))
+
+
+lease = InstanceLease(
+    lease_backend,
+    INSTANCE_ID,
+    ttl_seconds=LEASE_TTL,
+    on_lost=lambda: run_on_bot_loop(shutdown_after_lease_lost),
+    on_handoff_requested=lambda new_instance_id: run_on_bot_loop(drain_and_exit),
+    breaker=user_store.breaker,
+)
+
+
+def warm_up():
+    """リースを取る前に、Firestore / OpenAI への接続を張っておく"""
+    try:
+        lease_backend.read()
+        prewarm_ai("gentle_female")
+    except Exception as e:
+        print("ウォームアップエラー:", e)
+
+
+async def take_ownership():
+    loop = asyncio.get_running_loop()
+
+    await loop.run_in_executor(None, warm_up)
+
+    while not await loop.run_in_executor(lease_executor, lease.take_over, LEASE_TTL * 2):
+        print("リースを取得できませんでした。再試行します。")
+
+    # 貯めたメッセージの処理には時間がかかるので、先に更新を始めておく
+    asyncio.ensure_future(renew_lease_loop())
+
+    previous = lease.previous_record or {}
+    handled_by_previous = set()
+    if previous.get("released"):
+        try:
+            sessions, handled_by_previous, pending_writes = await loop.run_in_executor(
+                lease_executor, lease_backend.load_handoff, previous.get("token")
+            )
+            user_session.update(sessions)
+            user_store.import_pending(pending_writes)
+            if count_pending(pending_writes):
+                print(f"保留中の Firestore 書き込み {count_pending(pending_writes)} 件を引き継ぎました。")
+        except Exception as e:
+            print("セッション復元エラー:", e)
+
+    print(f"リースを取得しました（token={lease.token}）")
+
+    # 引き継ぎ中に届いた分を処理（旧インスタンスが処理済みの分は飛ばす）
+    while lease_state["pending"]:
+        message = lease_state["pending"].pop(0)
+        if message.id not in handled_by_previous:
+            await handle_message(message)
+    lease_state["starting"] = False
+
+
+async def renew_lease_loop():
+    # 更新に失敗しても処理は続ける（新しい token を見たときだけ on_lost で止まる）
+    # 明け渡し中も書き込みを出し切るまでは期限切れにならないよう、解放するまで続ける
+    loop = asyncio.get_running_loop()
+    while lease.token is not None:
+        await asyncio.sleep(LEASE_TTL / 3)
+        await loop.run_in_executor(lease_executor, lease.renew)
+
+
+async def drain_and_exit():
+    if lease_state["draining"]:
+        return
+    lease_state["draining"] = True
+    print("引き継ぎ依頼を受けました。処理中のメッセージを終えて明け渡します。")
+
+    loop = asyncio.get_running_loop()
+
+    # 処理中のメッセージを待つ（最大 5 秒）
+    for _ in range(500):
+        if not lease_state["in_flight"]:
+            break
+        await asyncio.sleep(0.01)
+
+    # 保留中の書き込みを出し切り、残った分はセッションと一緒に引き継ぎ先へ渡す
+    try:
+        await loop.run_in_executor(None, user_store.drain_pending, DRAIN_FLUSH_SECONDS)
+    except Exception as e:
+        print("保留書き込みの再送エラー:", e)
+    pending_writes = user_store.export_pending()
+
+    save_args = (lease.token, dict(user_session), list(lease_state["handled_ids"]))
+    try:
+        await loop.run_in_executor(lease_executor, lease_backend.save_handoff, *save_args, pending_writes)
+    except Exception as e:
+        print("セッション保存エラー:", e)
+        if count_pending(pending_writes):
+            # 大きすぎて保存できなかった場合に備え、セッションだけでも渡す
+            print(f"保留中の Firestore 書き込み {count_pending(pending_writes)} 件を引き継げず、破棄します。")
+            try:
+                await loop.run_in_executor(lease_executor, lease_backend.save_handoff, *save_args)
+            except Exception as e:
+                print("セッション保存エラー:", e)
+
+    try:
+        await loop.run_in_executor(lease_executor, lease.release)
+    except Exception as e:
+        print("リース解放エラー:", e)
+    lease.close()
+    await bot.close()
+
+
+async def shutdown_after_lease_lost():
+    if lease_state["draining"]:
+        return
+    lease_state["draining"] = True
+    print("リースを失いました。処理を止めて終了します。")
+    lease.close()
+    await bot.close()
+
+
 # ---------------------------------------------------------
 # Bot イベント
 # ---------------------------------------------------------
@@ -184,6 +341,13 @@ user_session = {}
 async def on_ready():
     print(f"Logged in as {bot.user}")
 
+    # 再接続でも on_ready は呼ばれるので、再送ループの起動と引き継ぎは一度だけ
+    if lease_state["takeover_started"]:
+        return
+    lease_state["takeover_started"] = True
+    asyncio.ensure_future(replay_pending_loop())
+    await take_ownership()
+
 
 @bot.event
 async def on_message(message: discord.Message):
@@ -192,6 +356,32 @@ async def on_message(message: discord.Message):
     if message.author.bot:
         return
 
+    if lease_state["starting"]:
+        if len(lease_state["pending"]) >= LEASE_PENDING_LIMIT:
+            print("引き継ぎ待ちのメッセージが上限に達したため破棄します:", message.id)
+            return
+        lease_state["pending"].append(message)
+        return
+
+    # より新しい token を見たインスタンスは何もしない（二重処理防止）
+    if lease_state["draining"] or not lease.is_owner():
+        return
+
+    await handle_message(message)
+
+
+async def handle_message(message: discord.Message):
+    lease_state["handled_ids"].append(message.id)
+
+    lease_state["in_flight"] += 1
+    try:
+        await process_message(message)
+    finally:
+        lease_state["in_flight"] -= 1
+
+
+async def process_message(message: discord.Message):
+
     content = message.content.strip()
     user_id = message.author.id
 
@@ -227,7 +417,7 @@ async def on_message(message: discord.Message):
     # 2) 体調チェックトリガー
     if contains(content, TRIGGER_WORDS):
 
-        state = get_user_state(user_id)
+        state = get_user_state_or_default(user_id)
 
         # 初回ユーザー → ガイド送付
         if not state or not state.get("seen_guide"):
@@ -237,7 +427,7 @@ async def on_message(message: discord.Message):
             except Exception as e:
                 print("GUIDE_TEXT DM 送信エラー:", e)
 
-        state = get_user_state(user_id)
+        state = get_user_state_or_default(user_id)
         if not state or "tone" not in state:
             try:
                 await message.author.send(
@@ -263,7 +453,7 @@ async def on_message(message: discord.Message):
         tone = state.get("tone", "gentle_female")
         q_text = QUESTION_TEMPLATES.get(tone, QUESTION_TEMPLATES["gentle_female"])["Q1"]
 
-        user_session[user_id] = {"mode": "Q1"}
+        user_session[user_id] = new_check_session(tone)
         try:
             await message.author.send(f"Q1：{q_text}")
             if message.guild is not None:
@@ -302,7 +492,7 @@ async def handle_session_message(message: discord.Message, content: str, user_id
 
         if session.get("after_tone_start_check"):
             q_text = QUESTION_TEMPLATES.get(tone, QUESTION_TEMPLATES["gentle_female"])["Q1"]
-            user_session[user_id] = {"mode": "Q1"}
+            user_session[user_id] = new_check_session(tone)
             await message.author.send(f"Q1：{q_text}")
         else:
             del user_session[user_id]
@@ -313,19 +503,26 @@ async def handle_session_message(message: discord.Message, content: str, user_id
     if mode in ["Q1", "Q2", "Q3", "Q4"]:
         set_user_state(user_id, {mode: content})
 
+        answers = session.setdefault("answers", {})
+        features = session.setdefault("features", {})
+        answers[mode] = content
+        features[mode] = analyze_answer(mode, content)
+
+        tone = session.get("tone")
+        user_state = None
+        if not tone or len(answers) < int(mode[1]):
+            # 古い形式のセッションなどで手元に無い分だけ Firestore から補う
+            user_state = get_user_state_or_default(user_id) or {}
+            tone = tone or user_state.get("tone", "gentle_female")
+            session["tone"] = tone
+
         if mode == "Q4":
-            user_state = get_user_state(user_id) or {}
-            tone = user_state.get("tone", "gentle_female")
-
-            answers = {
-                "Q1": user_state.get("Q1", ""),
-                "Q2": user_state.get("Q2", ""),
-                "Q3": user_state.get("Q3", ""),
-                "Q4": user_state.get("Q4", ""),
-            }
+            if user_state is not None:
+                for key in ["Q1", "Q2", "Q3"]:
+                    answers.setdefault(key, user_state.get(key, ""))
 
             try:
-                reply = generate_health_reply(tone, answers)
+                reply = generate_health_reply(tone, answers, features)
             except Exception as e:
                 print("generate_health_reply エラー:", e)
                 reply = "ごめんね、うまく解析できなかったみたい…時間をおいてもう一度試してもらえる？"
@@ -348,12 +545,16 @@ async def handle_session_message(message: discord.Message, content: str, user_id
         next_q_num = int(mode[1]) + 1
         next_q = f"Q{next_q_num}"
 
-        user_state = get_user_state(user_id) or {}
-        tone = user_state.get("tone", "gentle_female")
         q_text = QUESTION_TEMPLATES.get(tone, QUESTION_TEMPLATES["gentle_female"])[next_q]
 
         user_session[user_id]["mode"] = next_q
 
+        # AI 補足が必要と分かっていれば、Q4 を送るときに接続とプロンプトを用意しておく（1 セッション 1 回）
+        # （早すぎると Q4 の回答までに keep-alive が切れるので、Q3 の回答後に行う）
+        if next_q == "Q4" and not session.get("ai_prewarmed") and needs_ai_support(features):
+            session["ai_prewarmed"] = True
+            schedule_prewarm_ai(tone)
+
         try:
             await message.author.send(f"{next_q}：{q_text}")
         except Exception as e:
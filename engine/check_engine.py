@@ -1,13 +1,38 @@
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from typing import Dict, Optional
 
-from openai import OpenAI
+import httpx
+from openai import DefaultHttpxClient, OpenAI
+
+from engine.circuit_breaker import CLOSED, CircuitBreaker
 
 # OpenAI クライアント
-client = OpenAI()
+#   ・タイムアウトを短めにし、リトライは回路側の判断に任せる
+#   ・Q4 を待つ間に張った接続を使い回せるよう keep-alive を長めにとる
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "10"))
+OPENAI_KEEPALIVE = float(os.getenv("OPENAI_KEEPALIVE", "60"))
+client = OpenAI(
+    timeout=OPENAI_TIMEOUT,
+    max_retries=0,
+    http_client=DefaultHttpxClient(
+        limits=httpx.Limits(
+            max_connections=100,
+            max_keepalive_connections=20,
+            keepalive_expiry=OPENAI_KEEPALIVE,
+        ),
+    ),
+)
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
 
+# OpenAI が不調なときは AI 補足を丸ごとスキップする
+openai_breaker = CircuitBreaker("openai", slow_call_seconds=8.0)
+
+# 事前接続は専用スレッドで行う（OpenAI が遅いときに他の executor 処理を巻き込まない）
+_prewarm_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="openai-prewarm")
+
 # ---------------------------------------------------------
 # あいまい表現の検出
 # ---------------------------------------------------------
@@ -128,6 +153,56 @@ def classify_tags(answer: str):
     return tags
 
 
+# ---------------------------------------------------------
+# 回答ごとの特徴量
+#   ・bot 側で回答が届くたびに analyze_answer を呼んでセッションに保存
+#   ・Q4 の時点では Q4 の解析と AI 呼び出しだけが残る
+# ---------------------------------------------------------
+
+QUESTION_KEYS = ["Q1", "Q2", "Q3", "Q4"]
+
+SLEEP_BAD_WORDS = ["眠れ", "寝れな", "ねむれな", "徹夜", "全然寝", "ほとんど寝てない"]
+
+WARNED_TAGS = ["pain", "eye_strain", "fatigue", "mental"]
+
+
+def analyze_answer(key: str, text: str) -> Dict:
+    """1問分の回答から、返信と AI 判定に使う特徴量を取り出す"""
+    features = {"ambiguous": contains_ambiguous(text)}
+
+    if key == "Q1":
+        features["minutes"] = extract_play_minutes(text)
+    elif key in ["Q2", "Q4"]:
+        features["tags"] = classify_tags(text)
+    elif key == "Q3":
+        lower = (text or "").lower()
+        features["sleep_bad"] = any(k in lower for k in SLEEP_BAD_WORDS)
+
+    return features
+
+
+def analyze_answers(answers: Dict[str, str], features: Optional[Dict[str, Dict]] = None) -> Dict[str, Dict]:
+    """まだ解析していない回答だけを解析して、4問分の特徴量をそろえる"""
+    features = dict(features or {})
+    for key in QUESTION_KEYS:
+        if key not in features:
+            features[key] = analyze_answer(key, answers.get(key, ""))
+    return features
+
+
+def needs_ai_support(features: Dict[str, Dict]) -> bool:
+    """
+    AI 補足が必要かどうか。
+    途中までの特徴量でも True なら確定（後の回答で False に戻ることはない）。
+    """
+    for f in features.values():
+        if f.get("ambiguous"):
+            return True
+        if any(t in WARNED_TAGS for t in f.get("tags", [])):
+            return True
+    return False
+
+
 # ---------------------------------------------------------
 # トーン別テンプレ
 # ---------------------------------------------------------
@@ -230,29 +305,9 @@ TEMPLATES: Dict[str, Dict[str, str]] = {
 # AI 補足生成
 # ---------------------------------------------------------
 
-def build_ai_prompt(
-    tone: str,
-    answers: Dict[str, str],
-    minutes: Optional[int],
-    tags_q2,
-    tags_q4,
-) -> Optional[str]:
-    """条件を満たす場合のみ AI 用プロンプト文字列を返す"""
-
-    needs_ai = False
-
-    for key in ["Q1", "Q2", "Q3", "Q4"]:
-        if contains_ambiguous(answers.get(key, "")):
-            needs_ai = True
-            break
-
-    warned_tags = set(tags_q2) | set(tags_q4)
-    if any(t in warned_tags for t in ["pain", "eye_strain", "fatigue", "mental"]):
-        needs_ai = True
-
-    if not needs_ai:
-        return None
-
+@lru_cache(maxsize=None)
+def build_system_prompt(tone: str) -> str:
+    """トーンだけで決まるプロンプト前半（回答を待たずに用意できる）"""
     tone_label = {
         "gentle_female": "やさしい女性",
         "bright_girl": "明るい女の子",
@@ -262,6 +317,25 @@ def build_ai_prompt(
         "calm_male": "落ち着いた男性",
     }.get(tone, "やさしい女性")
 
+    return (
+        f"あなたは日本語で話す{tone_label}のキャラクターです。"
+        "ユーザーはゲームの遊びすぎや疲れすぎが気になっている人です。"
+        "以下の回答を読み、ユーザーを責めずに、やさしく・具体的に・100文字以内で一言アドバイスを返してください。"
+        "禁止事項：診断名をつける、治療行為を断定する、脅かす表現。"
+    )
+
+
+def build_ai_prompt(
+    tone: str,
+    answers: Dict[str, str],
+    features: Dict[str, Dict],
+) -> Optional[str]:
+    """条件を満たす場合のみ AI 用プロンプト文字列を返す"""
+
+    if not needs_ai_support(features):
+        return None
+
+    minutes = features.get("Q1", {}).get("minutes")
     if minutes is None:
         play_summary = "プレイ時間ははっきりとはわからないと答えている。"
     else:
@@ -281,13 +355,6 @@ def build_ai_prompt(
         f"Q4（気分）: {answers.get('Q4','')}"
     )
 
-    system_prompt = (
-        f"あなたは日本語で話す{tone_label}のキャラクターです。"
-        "ユーザーはゲームの遊びすぎや疲れすぎが気になっている人です。"
-        "以下の回答を読み、ユーザーを責めずに、やさしく・具体的に・100文字以内で一言アドバイスを返してください。"
-        "禁止事項：診断名をつける、治療行為を断定する、脅かす表現。"
-    )
-
     user_prompt = (
         "ユーザーの回答:\n"
         f"{user_text}\n\n"
@@ -295,14 +362,37 @@ def build_ai_prompt(
         "気になりそうな点があれば1〜3個だけ簡潔に触れてください。"
     )
 
-    return system_prompt + "\n\n" + user_prompt
+    return build_system_prompt(tone) + "\n\n" + user_prompt
+
+
+def prewarm_ai(tone: str):
+    """
+    Q4 を送るとき（AI 補足が必要だと分かっていれば）呼ぶ。
+    プロンプト前半を用意し、OpenAI への接続を先に張っておく。
+    接続は OPENAI_KEEPALIVE 秒で切れるので、早く呼びすぎると Q4 の回答時には残っていない。
+    """
+    build_system_prompt(tone)
+
+    # half_open の試し打ちは本番の呼び出しに任せる
+    if openai_breaker.state != CLOSED:
+        return
+    try:
+        openai_breaker.call(client.models.retrieve, OPENAI_MODEL)
+    except Exception:
+        pass
+
+
+def schedule_prewarm_ai(tone: str):
+    """prewarm_ai を専用スレッドで実行する（呼び出し側は待たない）"""
+    _prewarm_executor.submit(prewarm_ai, tone)
 
 
 def call_openai(system_and_user_prompt: str) -> Optional[str]:
-    """OpenAI API を呼び出し、一言アドバイスを返す"""
+    """OpenAI API を呼び出し、一言アドバイスを返す（回路が open なら即 None）"""
     try:
         system_prompt, user_prompt = system_and_user_prompt.split("\n\n", 1)
-        resp = client.chat.completions.create(
+        resp = openai_breaker.call(
+            client.chat.completions.create,
             model=OPENAI_MODEL,
             messages=[
                 {"role": "system", "content": system_prompt},
@@ -320,20 +410,22 @@ def call_openai(system_and_user_prompt: str) -> Optional[str]:
 # メイン：フィードバック生成
 # ---------------------------------------------------------
 
-def generate_health_reply(tone: str, answers: Dict[str, str]) -> str:
+def generate_health_reply(
+    tone: str,
+    answers: Dict[str, str],
+    features: Optional[Dict[str, Dict]] = None,
+) -> str:
     """
     tone: "gentle_female" など
     answers: {"Q1": "...", "Q2": "...", "Q3": "...", "Q4": "..."}
+    features: analyze_answer の結果 {"Q1": {...}, ...}（足りない分はここで解析）
     """
     tone = tone or "gentle_female"
     tmpl = TEMPLATES.get(tone, TEMPLATES["gentle_female"])
 
-    q1 = answers.get("Q1", "")
-    q2 = answers.get("Q2", "")
-    q3 = answers.get("Q3", "")
-    q4 = answers.get("Q4", "")
+    features = analyze_answers(answers, features)
 
-    minutes = extract_play_minutes(q1)
+    minutes = features["Q1"].get("minutes")
     pt_class = classify_play_time(minutes)
 
     if pt_class == "short":
@@ -347,16 +439,15 @@ def generate_health_reply(tone: str, answers: Dict[str, str]) -> str:
     else:
         play_text = "● プレイ時間：はっきりとは分からないみたいだけれど、自分なりの“やりすぎライン”を意識してみよう。"
 
-    cond_tags = classify_tags(q2)
-    mood_tags = classify_tags(q4)
+    cond_tags = features["Q2"].get("tags", [])
+    mood_tags = features["Q4"].get("tags", [])
 
     if "pain" in cond_tags or "fatigue" in cond_tags:
         cond_text = tmpl["condition_bad"]
     else:
         cond_text = tmpl["condition_good"]
 
-    sleep_text_lower = q3.lower()
-    if any(k in sleep_text_lower for k in ["眠れ", "寝れな", "ねむれな", "徹夜", "全然寝", "ほとんど寝てない"]):
+    if features["Q3"].get("sleep_bad"):
         sleep_text = tmpl["sleep_bad"]
     else:
         sleep_text = tmpl["sleep_good"]
@@ -376,7 +467,7 @@ def generate_health_reply(tone: str, answers: Dict[str, str]) -> str:
         mood_text,
     ]
 
-    ai_prompt = build_ai_prompt(tone, answers, minutes, cond_tags, mood_tags)
+    ai_prompt = build_ai_prompt(tone, answers, features)
     if ai_prompt:
         ai_msg = call_openai(ai_prompt)
         if ai_msg:
@@ -0,0 +1,122 @@
+import threading
+import time
+from collections import deque
+from typing import Callable
+
+# ---------------------------------------------------------
+# サーキットブレーカー
+#   ・直近の呼び出し結果からエラー率を見て open にする
+#   ・しきい値より遅い呼び出しも「失敗」として数える
+#   ・open から一定時間たったら half_open で 1 件だけ試す
+# ---------------------------------------------------------
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """回路が open のため呼び出しを行わなかったことを表す"""
+
+    def __init__(self, name: str):
+        super().__init__(f"circuit '{name}' is open")
+        self.name = name
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str,
+        failure_rate_threshold: float = 0.5,
+        slow_call_seconds: float = 5.0,
+        window_size: int = 10,
+        min_calls: int = 4,
+        open_seconds: float = 30.0,
+    ):
+        self.name = name
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+
+        self._lock = threading.Lock()
+        self._results = deque(maxlen=window_size)  # True = 成功 / False = 失敗・遅延
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            self._refresh_state()
+            return self._state
+
+    def _refresh_state(self):
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+            self._state = HALF_OPEN
+            self._probe_in_flight = False
+
+    def _trip(self):
+        if self._state != OPEN:
+            print(f"[circuit:{self.name}] open")
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+        self._probe_in_flight = False
+        self._results.clear()
+
+    def allow_request(self) -> bool:
+        """呼び出してよいか判定する（half_open では同時に 1 件だけ通す）"""
+        with self._lock:
+            self._refresh_state()
+            if self._state == CLOSED:
+                return True
+            if self._state == HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self, elapsed: float = 0.0):
+        if elapsed > self.slow_call_seconds:
+            self.record_failure()
+            return
+
+        with self._lock:
+            if self._state == HALF_OPEN:
+                print(f"[circuit:{self.name}] closed")
+                self._state = CLOSED
+                self._probe_in_flight = False
+                self._results.clear()
+            self._results.append(True)
+
+    def record_failure(self):
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._trip()
+                return
+
+            self._results.append(False)
+            if len(self._results) < self.min_calls:
+                return
+
+            failures = self._results.count(False)
+            if failures / len(self._results) >= self.failure_rate_threshold:
+                self._trip()
+
+    def call(self, func: Callable, *args, **kwargs):
+        """
+        func を回路越しに呼び出す。
+        open 中は func を呼ばずに CircuitOpenError を送出する。
+        """
+        if not self.allow_request():
+            raise CircuitOpenError(self.name)
+
+        start = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self.record_failure()
+            raise
+
+        self.record_success(time.monotonic() - start)
+        return result
+
@@ -0,0 +1,327 @@
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from google.api_core import exceptions as gexc
+
+# ---------------------------------------------------------
+# 単一インスタンス用リース（デプロイ時の引き継ぎ）
+#   ・データストア上の 1 レコードを「持っている」インスタンスだけが処理する
+#   ・token は取得のたびに +1 される世代番号。遅れて届いた古い通知と
+#     持ち主の交代を見分けるのに使う
+#   ・新インスタンスは handoff_to を書いて旧インスタンスに明け渡しを依頼し、
+#     旧インスタンスは処理を止めてセッション・処理済みメッセージ ID・
+#     送り切れなかった Firestore 書き込みを保存 → released を書いて終了する
+#
+# 注意：ユーザー状態・ログの書き込みは token を検査しない（fencing ではない）。
+#   旧インスタンスが新しい token に気づけない間（変更通知の遅延や、
+#   旧インスタンス側の通信断でリースが期限切れ扱いになった場合）は、
+#   両方が同じメッセージを処理して二重に返信・書き込みすることがありうる。
+#   通常の引き継ぎ（handoff_to → released）ではこの状態にはならない。
+#
+# レコード形式：
+#   {
+#     "holder": インスタンス ID,
+#     "token": int,
+#     "expires_at": UNIX 時刻,
+#     "released": True/False,
+#     "handoff_to": 引き継ぎ先インスタンス ID or None,
+#   }
+# ---------------------------------------------------------
+
+LEASE_COLLECTION = "bot_leases"
+
+
+class FirestoreLeaseBackend:
+    def __init__(self, db, lease_name: str = "discord_bot", timeout: float = 3.0):
+        self.db = db
+        self.timeout = timeout
+        self.ref = db.collection(LEASE_COLLECTION).document(lease_name)
+        self.handoff_ref = self.ref.collection("handoff").document("state")
+
+    def read(self) -> Optional[dict]:
+        doc = self.ref.get(timeout=self.timeout)
+        return doc.to_dict() if doc.exists else None
+
+    def compare_and_update(self, expected_token: Optional[int], fields: dict) -> bool:
+        """
+        現在の token が expected_token のときだけ fields を書き込む。
+        トランザクションはタイムアウトを指定できないので、
+        update_time を前提条件にした書き込みで代用する。
+        """
+        while True:
+            snap = self.ref.get(timeout=self.timeout)
+            current = snap.to_dict() if snap.exists else None
+            token = current.get("token") if current else None
+            if token != expected_token:
+                return False
+
+            try:
+                if snap.exists:
+                    self.ref.update(
+                        fields,
+                        option=self.db.write_option(last_update_time=snap.update_time),
+                        timeout=self.timeout,
+                    )
+                else:
+                    self.ref.create(fields, timeout=self.timeout)
+                return True
+            except (gexc.FailedPrecondition, gexc.Conflict):
+                # 読んでから書くまでの間に誰かが書いた → 読み直して token を確かめる
+                continue
+
+    def watch(self, callback: Callable[[Optional[dict]], None]) -> Callable[[], None]:
+        def _on_snapshot(docs, changes, read_time):
+            for doc in docs:
+                callback(doc.to_dict() if doc.exists else None)
+
+        watch = self.ref.on_snapshot(_on_snapshot)
+        return watch.unsubscribe
+
+    def save_handoff(
+        self,
+        token: int,
+        sessions: Dict[int, dict],
+        handled_message_ids: List[int],
+        pending_writes: Optional[dict] = None,
+    ):
+        self.handoff_ref.set(
+            {
+                "token": token,
+                "sessions": {str(uid): s for uid, s in sessions.items()},
+                "handled_message_ids": list(handled_message_ids),
+                "pending_writes": pending_writes,
+            },
+            timeout=self.timeout,
+        )
+
+    def load_handoff(self, token: int) -> Tuple[Dict[int, dict], Set[int], Optional[dict]]:
+        """token のリース保持者が保存した分だけを返す（古い保存分は無視）"""
+        doc = self.handoff_ref.get(timeout=self.timeout)
+        data = doc.to_dict() if doc.exists else None
+        if not data or data.get("token") != token:
+            return {}, set(), None
+        sessions = {int(uid): s for uid, s in (data.get("sessions") or {}).items()}
+        return sessions, set(data.get("handled_message_ids") or []), data.get("pending_writes")
+
+
+class LocalLeaseBackend:
+    """プロセス内だけで完結するリース保存先（テスト・ローカル実行用）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._record: Optional[dict] = None
+        self._handoff_token: Optional[int] = None
+        self._sessions: Dict[int, dict] = {}
+        self._handled_message_ids: Set[int] = set()
+        self._pending_writes: Optional[dict] = None
+        self._watchers = []
+
+    def read(self) -> Optional[dict]:
+        with self._lock:
+            return dict(self._record) if self._record is not None else None
+
+    def compare_and_update(self, expected_token: Optional[int], fields: dict) -> bool:
+        with self._lock:
+            token = self._record.get("token") if self._record else None
+            if token != expected_token:
+                return False
+            self._record = {**(self._record or {}), **fields}
+            record = dict(self._record)
+            watchers = list(self._watchers)
+
+        for callback in watchers:
+            callback(record)
+        return True
+
+    def watch(self, callback: Callable[[Optional[dict]], None]) -> Callable[[], None]:
+        with self._lock:
+            self._watchers.append(callback)
+
+        def _unsubscribe():
+            with self._lock:
+                if callback in self._watchers:
+                    self._watchers.remove(callback)
+
+        return _unsubscribe
+
+    def save_handoff(
+        self,
+        token: int,
+        sessions: Dict[int, dict],
+        handled_message_ids: List[int],
+        pending_writes: Optional[dict] = None,
+    ):
+        with self._lock:
+            self._handoff_token = token
+            self._sessions = {uid: dict(s) for uid, s in sessions.items()}
+            self._handled_message_ids = set(handled_message_ids)
+            self._pending_writes = pending_writes
+
+    def load_handoff(self, token: int) -> Tuple[Dict[int, dict], Set[int], Optional[dict]]:
+        with self._lock:
+            if self._handoff_token != token:
+                return {}, set(), None
+            return (
+                {uid: dict(s) for uid, s in self._sessions.items()},
+                set(self._handled_message_ids),
+                self._pending_writes,
+            )
+
+
+class InstanceLease:
+    def __init__(
+        self,
+        backend,
+        instance_id: str,
+        ttl_seconds: float = 15.0,
+        on_lost: Optional[Callable[[], None]] = None,
+        on_handoff_requested: Optional[Callable[[str], None]] = None,
+        breaker=None,
+    ):
+        self.backend = backend
+        self.instance_id = instance_id
+        self.ttl_seconds = ttl_seconds
+        self.breaker = breaker  # 更新（renew）だけ回路越しに行う
+        self.on_lost = on_lost
+        self.on_handoff_requested = on_handoff_requested
+
+        self.token: Optional[int] = None
+        self.previous_record: Optional[dict] = None  # 取得直前のレコード（引き継ぎ元の情報）
+
+        self._handoff_notified = False
+        self._changed = threading.Event()
+        self._unsubscribe = backend.watch(self._on_record)
+
+    # --- 状態 ---
+
+    def is_owner(self) -> bool:
+        """
+        より新しい token を見るまでは持ち主として振る舞う。
+        更新に失敗しているだけ（データストア障害中など）では手放さない。
+        """
+        return self.token is not None
+
+    def _is_free(self, record: Optional[dict]) -> bool:
+        if not record:
+            return True
+        if record.get("holder") == self.instance_id:
+            return True
+        return bool(record.get("released")) or record.get("expires_at", 0) <= time.time()
+
+    # --- 取得・更新・解放 ---
+
+    def acquire(self) -> bool:
+        record = self.backend.read()
+        if not self._is_free(record):
+            return False
+
+        expected = record.get("token") if record else None
+        new_token = (expected or 0) + 1
+        ok = self.backend.compare_and_update(
+            expected,
+            {
+                "holder": self.instance_id,
+                "token": new_token,
+                "expires_at": time.time() + self.ttl_seconds,
+                "released": False,
+                "handoff_to": None,
+            },
+        )
+        if ok:
+            self.token = new_token
+            self.previous_record = record
+            self._handoff_notified = False
+        return ok
+
+    def renew(self) -> bool:
+        """
+        期限を延ばす。失敗しても持ち主のまま次の更新で再挑戦し、
+        より新しい token が書かれていたときだけ手放す。
+        """
+        if self.token is None:
+            return False
+
+        token = self.token
+        fields = {"expires_at": time.time() + self.ttl_seconds}
+        try:
+            if self.breaker:
+                ok = self.breaker.call(self.backend.compare_and_update, token, fields)
+            else:
+                ok = self.backend.compare_and_update(token, fields)
+        except Exception as e:
+            print("リース更新エラー:", e)
+            return False
+
+        if not ok and self.token == token:
+            self._lose()
+        return ok
+
+    def release(self):
+        """明け渡す（save_handoff を済ませてから呼ぶこと）"""
+        if self.token is None:
+            return
+        token = self.token
+        self.token = None
+        self.backend.compare_and_update(token, {"released": True})
+
+    def take_over(self, timeout: float) -> bool:
+        """
+        旧インスタンスに明け渡しを依頼し、解放（または期限切れ）を待ってから取得する。
+        ブロックするので executor から呼ぶこと。
+        """
+        deadline = time.monotonic() + timeout
+        requested = False
+
+        while True:
+            # 読み込み後に届いた変更通知を取りこぼさないよう、先にクリアしておく
+            self._changed.clear()
+            record = self.backend.read()
+            if self._is_free(record):
+                if self.acquire():
+                    return True
+                continue
+
+            if not requested:
+                requested = self.backend.compare_and_update(
+                    record.get("token"), {"handoff_to": self.instance_id}
+                )
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+
+            # 変更通知が来ればすぐ、来なくても期限切れに備えて短い間隔で見直す
+            self._changed.wait(min(remaining, 0.5))
+
+    def close(self):
+        self._unsubscribe()
+
+    # --- 変更通知 ---
+
+    def _lose(self):
+        if self.token is None:
+            return
+        self.token = None
+        if self.on_lost:
+            self.on_lost()
+
+    def _on_record(self, record: Optional[dict]):
+        self._changed.set()
+
+        if self.token is None:
+            return
+
+        token = record.get("token") if record else None
+        if token is None or token > self.token:
+            self._lose()
+            return
+        if token < self.token:
+            # 自分が取得する前の古い通知が遅れて届いただけ
+            return
+
+        handoff_to = record.get("handoff_to")
+        if handoff_to and handoff_to != self.instance_id and not self._handoff_notified:
+            self._handoff_notified = True
+            if self.on_handoff_requested:
+                self.on_handoff_requested(handoff_to)
@@ -0,0 +1,22 @@
+# ---------------------------------------------------------
+# トーン（性格）
+#   bot.py（トーン選択）と admin.py（migrate-tone の検証）で共有する
+# ---------------------------------------------------------
+
+TONE_CHOICES = {
+    "1": "gentle_female",
+    "2": "bright_girl",
+    "3": "cheerful_friend",  # 気さくで快活な女子
+    "4": "cool_girl",
+    "5": "strict_female",
+    "6": "calm_male",
+}
+
+TONE_LABELS = {
+    "gentle_female": "やさしい女性",
+    "bright_girl": "明るい女の子",
+    "cheerful_friend": "気さくで快活な女子",
+    "cool_girl": "クールな女性",
+    "strict_female": "厳しめの女性",
+    "calm_male": "落ち着いた男性",
+}
@@ -0,0 +1,353 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import firebase_admin
+from firebase_admin import credentials, firestore
+from google.api_core import exceptions as gexc
+
+from engine.circuit_breaker import OPEN, CircuitBreaker, CircuitOpenError
+
+# ---------------------------------------------------------
+# Firestore 操作（ユーザー状態・ログ）
+#   ・Firestore が不調なときは回路を open にして待たない
+#   ・open 中は tone などをメモリ上のキャッシュから返す
+#   ・書き込めなかった状態・ログは保留キューに積み、復旧後に再送
+# ---------------------------------------------------------
+
+COLLECTION_NAME = "user_health"
+FIRESTORE_TIMEOUT = float(os.getenv("FIRESTORE_TIMEOUT", "5"))
+PENDING_LOG_LIMIT = int(os.getenv("PENDING_LOG_LIMIT", "10000"))
+
+# Firestore に繋がらないときに返せるよう、メモリに残しておくユーザー数（LRU）
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+
+# 1 回の再送で送る件数・時間の上限（残りは次回に持ち越す）
+REPLAY_MAX_ITEMS = int(os.getenv("REPLAY_MAX_ITEMS", "50"))
+REPLAY_MAX_SECONDS = float(os.getenv("REPLAY_MAX_SECONDS", "2"))
+
+# バッチ書き込みの上限（Firestore は 500 件 / 10MiB。サイズは余裕を持たせる）
+BATCH_WRITE_LIMIT = 500
+BATCH_BYTES_LIMIT = 9 * 1024 * 1024
+
+
+def init_firestore():
+    """Firebase 接続（Render / ローカル両対応）"""
+    firebase_json = os.getenv("FIREBASE_CREDENTIALS")
+
+    if firebase_json:
+        try:
+            cred_dict = json.loads(firebase_json)
+            cred = credentials.Certificate(cred_dict)
+            firebase_admin.initialize_app(cred)
+            print("Firebase initialized from environment variable.")
+        except Exception as e:
+            print("Firebase JSON 読み込みエラー:", e)
+            raise
+    else:
+        print("FIREBASE_CREDENTIALS が設定されていません。")
+        raise ValueError("Firebase credentials missing.")
+
+    return firestore.client()
+
+
+def split_batches(updates: List[tuple]) -> List[List[tuple]]:
+    """(uid, data, ...) のリストを、件数・サイズの上限に収まるバッチに分ける"""
+    batches = []
+    current = []
+    current_bytes = 0
+
+    for item in updates:
+        uid, data = item[0], item[1]
+        # DELETE_FIELD などの番兵も含むので、repr でおおよそのサイズを見積もる
+        size = len(uid) + len(repr(data).encode("utf-8"))
+        if current and (len(current) >= BATCH_WRITE_LIMIT or current_bytes + size > BATCH_BYTES_LIMIT):
+            batches.append(current)
+            current = []
+            current_bytes = 0
+        current.append(item)
+        current_bytes += size
+
+    if current:
+        batches.append(current)
+    return batches
+
+
+class UserStateUnavailable(Exception):
+    """Firestore から読めず、キャッシュにも無いため状態が分からない（「ユーザーがいない」とは別）"""
+
+
+class UserStore:
+    def __init__(self, db, breaker: Optional[CircuitBreaker] = None):
+        self.db = db
+        self.breaker = breaker or CircuitBreaker("firestore", slow_call_seconds=2.0)
+
+        # _cache[uid] = 最後に読み込んだユーザー状態（LRU で USER_CACHE_SIZE 件まで）
+        self._cache: "OrderedDict[str, dict]" = OrderedDict()
+        # _pending_states[uid] = まだ Firestore に反映できていない差分（merge 用）
+        self._pending_states: Dict[str, dict] = {}
+        # _pending_logs = [(uid, log_entry), ...]
+        self._pending_logs = deque(maxlen=PENDING_LOG_LIMIT)
+        # _replaying = 再送中のユーザー（その間の書き込みも保留側に積んで順序を守る）
+        self._replaying = set()
+        # 再送はバックグラウンドのスレッドで行うので、保留キューの操作はこのロックで守る
+        self._pending_lock = threading.Lock()
+        # 再送そのものは同時に 1 つだけ（同じユーザーの差分を追い越して書かないように）
+        self._flush_lock = threading.Lock()
+
+    def _doc(self, user_id):
+        return self.db.collection(COLLECTION_NAME).document(str(user_id))
+
+    def _remember(self, key: str, data: dict):
+        self._cache[key] = dict(data)
+        self._cache.move_to_end(key)
+        while len(self._cache) > USER_CACHE_SIZE:
+            self._cache.popitem(last=False)
+
+    def get_user_state(self, user_id: int) -> Optional[dict]:
+        """
+        ユーザー状態を返す（存在しなければ None）。
+        Firestore が使えずキャッシュにも無いときは UserStateUnavailable を送出する。
+        """
+        key = str(user_id)
+        try:
+            doc = self.breaker.call(self._doc(key).get, timeout=FIRESTORE_TIMEOUT)
+        except Exception as e:
+            if not isinstance(e, CircuitOpenError):
+                print("Firestore 読み込みエラー:", e)
+            cached = self._cache.get(key)
+            if cached is None:
+                raise UserStateUnavailable(key) from e
+            self._cache.move_to_end(key)
+            return dict(cached)
+
+        data = doc.to_dict() if doc.exists else None
+
+        # 未反映の書き込みがあれば、それを優先して重ねる
+        pending = self._pending_states.get(key)
+        if pending:
+            data = {**(data or {}), **pending}
+
+        if data is not None:
+            self._remember(key, data)
+        return data
+
+    def set_user_state(self, user_id: int, data: dict):
+        key = str(user_id)
+
+        # 読み込んだことのあるユーザーだけキャッシュに重ねる
+        # （一部のフィールドだけのキャッシュを「全体」として返さないため）
+        if key in self._cache:
+            self._cache[key].update(data)
+            self._cache.move_to_end(key)
+
+        # 先に保留中の書き込みがあるなら順序を守るため後ろに積む
+        with self._pending_lock:
+            queued = key in self._pending_states or key in self._replaying
+
+        if not queued:
+            try:
+                self.breaker.call(self._doc(key).set, data, merge=True, timeout=FIRESTORE_TIMEOUT)
+                return
+            except Exception as e:
+                if not isinstance(e, CircuitOpenError):
+                    print("Firestore 書き込みエラー:", e)
+
+        with self._pending_lock:
+            self._pending_states.setdefault(key, {}).update(data)
+
+    def add_log(self, user_id: int, tone: str, answers: dict, reply: str):
+        """
+        users/{uid}/logs/{auto_id} にログ保存（簡易版）
+        """
+        key = str(user_id)
+        entry = {
+            "tone": tone,
+            "Q1": answers.get("Q1", ""),
+            "Q2": answers.get("Q2", ""),
+            "Q3": answers.get("Q3", ""),
+            "Q4": answers.get("Q4", ""),
+            "reply": reply,
+        }
+
+        if not self._pending_logs:
+            try:
+                self.breaker.call(
+                    self._doc(key).collection("logs").add,
+                    {**entry, "timestamp": firestore.SERVER_TIMESTAMP},
+                    timeout=FIRESTORE_TIMEOUT,
+                )
+                return
+            except Exception as e:
+                if not isinstance(e, CircuitOpenError):
+                    print("ログ保存エラー:", e)
+
+        # 再送時にサーバー時刻になってしまわないよう、ここで時刻を確定させる
+        entry["timestamp"] = datetime.now(timezone.utc)
+        with self._pending_lock:
+            self._pending_logs.append((key, entry))
+
+    # --- 一括メンテナンス用（admin.py から利用） ---
+
+    def iter_user_pages(self, page_size: int = 500, start_after: Optional[str] = None) -> Iterator[list]:
+        """ユーザードキュメントを ID 順にページごとに返す（start_after の次から）"""
+        doc_id = "__name__"  # ドキュメント ID で並べるときのフィールドパス
+
+        while True:
+            query = self.db.collection(COLLECTION_NAME).order_by(doc_id).limit(page_size)
+            if start_after:
+                query = query.start_after({doc_id: start_after})
+
+            docs = list(query.stream(timeout=FIRESTORE_TIMEOUT * 6))
+            if not docs:
+                return
+            yield docs
+
+            if len(docs) < page_size:
+                return
+            start_after = docs[-1].id
+
+    def commit_user_states(self, updates: List[Tuple[str, dict, object]]) -> List[str]:
+        """
+        split_batches で分けた 1 バッチ分 [(uid, data, 読み込んだときの update_time), ...] を書き込む。
+        読み込んだ後に bot 側で書き換えられたドキュメントは上書きせず、その uid を返す。
+        """
+        timeout = FIRESTORE_TIMEOUT * 6
+
+        batch = self.db.batch()
+        for uid, data, update_time in updates:
+            batch.update(self._doc(uid), data, option=self.db.write_option(last_update_time=update_time))
+        try:
+            batch.commit(timeout=timeout)
+            return []
+        except (gexc.FailedPrecondition, gexc.NotFound):
+            pass
+
+        # バッチは 1 件でも前提条件を満たさないと丸ごと失敗するので、1 件ずつやり直す
+        conflicts = []
+        for uid, data, update_time in updates:
+            try:
+                self._doc(uid).update(
+                    data,
+                    option=self.db.write_option(last_update_time=update_time),
+                    timeout=timeout,
+                )
+            except (gexc.FailedPrecondition, gexc.NotFound):
+                conflicts.append(uid)
+        return conflicts
+
+    def has_pending(self) -> bool:
+        with self._pending_lock:
+            return bool(self._pending_states or self._pending_logs)
+
+    def flush_pending(
+        self, max_items: Optional[int] = REPLAY_MAX_ITEMS, max_seconds: float = REPLAY_MAX_SECONDS
+    ) -> bool:
+        """
+        保留中の状態・ログを再送する。
+        ブロックするのでイベントループの外（executor）から呼ぶこと。
+        件数（None なら無制限）・時間の上限に達するか失敗したら残りは次回に持ち越し、
+        まだ残っていれば True を返す。別スレッドで再送中なら終わるのを待つ。
+        """
+        with self._flush_lock:
+            return self._flush_pending(max_items, max_seconds)
+
+    def _flush_pending(self, max_items: Optional[int], max_seconds: float) -> bool:
+        if max_items is None:
+            max_items = float("inf")
+        deadline = time.monotonic() + max_seconds
+        sent = 0
+
+        while sent < max_items and time.monotonic() < deadline:
+            with self._pending_lock:
+                if not self._pending_states:
+                    break
+                key = next(iter(self._pending_states))
+                data = self._pending_states.pop(key)
+                self._replaying.add(key)
+
+            try:
+                self.breaker.call(self._doc(key).set, data, merge=True, timeout=FIRESTORE_TIMEOUT)
+            except Exception:
+                with self._pending_lock:
+                    # 再送中に積まれた新しい差分を優先して戻す
+                    self._pending_states[key] = {**data, **self._pending_states.get(key, {})}
+                    self._replaying.discard(key)
+                return True
+
+            with self._pending_lock:
+                self._replaying.discard(key)
+            sent += 1
+
+        while sent < max_items and time.monotonic() < deadline:
+            with self._pending_lock:
+                if not self._pending_logs:
+                    break
+                key, entry = self._pending_logs.popleft()
+
+            try:
+                self.breaker.call(self._doc(key).collection("logs").add, entry, timeout=FIRESTORE_TIMEOUT)
+            except Exception:
+                with self._pending_lock:
+                    self._pending_logs.appendleft((key, entry))
+                return True
+            sent += 1
+
+        if sent:
+            print(f"保留中の Firestore 書き込みを {sent} 件再送しました。")
+        return self.has_pending()
+
+    def drain_pending(self, max_seconds: float) -> bool:
+        """
+        終了前に保留中の書き込みを出し切る（max_seconds まで）。
+        回路が open のときは待っても送れないので諦める。残っていれば True を返す。
+        """
+        deadline = time.monotonic() + max_seconds
+        while self.has_pending():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self.breaker.state == OPEN:
+                return True
+            if self.flush_pending(None, remaining):
+                time.sleep(min(0.5, max(0.0, deadline - time.monotonic())))
+        return False
+
+    # --- 引き継ぎ用（新インスタンスに保留中の書き込みを渡す） ---
+    #   {"states": {uid: 差分}, "logs": [{"uid": uid, "entry": ログ}, ...]}
+    #   （Firestore は配列の入れ子を保存できないので、ログは dict にする）
+
+    def export_pending(self) -> dict:
+        """保留中の書き込みを取り出して空にする"""
+        with self._pending_lock:
+            pending = {
+                "states": {key: dict(data) for key, data in self._pending_states.items()},
+                "logs": [{"uid": key, "entry": entry} for key, entry in self._pending_logs],
+            }
+            self._pending_states.clear()
+            self._pending_logs.clear()
+        return pending
+
+    def import_pending(self, pending: Optional[dict]):
+        """export_pending で受け取った書き込みを、手元の保留分より前に積む"""
+        if not pending:
+            return
+        with self._pending_lock:
+            for key, data in (pending.get("states") or {}).items():
+                # 手元の差分のほうが新しいので優先する
+                self._pending_states[key] = {**data, **self._pending_states.get(key, {})}
+            logs = [(item["uid"], item["entry"]) for item in pending.get("logs") or []]
+            room = PENDING_LOG_LIMIT - len(self._pending_logs)
+            if len(logs) > room:
+                print(f"保留ログが上限を超えるため、引き継いだ古いログ {len(logs) - room} 件を破棄します。")
+                logs = logs[len(logs) - room:] if room > 0 else []
+            self._pending_logs.extendleft(reversed(logs))
+
+
+def count_pending(pending: Optional[dict]) -> int:
+    """export_pending の戻り値に含まれる書き込み件数"""
+    if not pending:
+        return 0
+    return len(pending.get("states") or {}) + len(pending.get("logs") or [])
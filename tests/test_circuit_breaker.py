@@ -0,0 +1,101 @@
+import time
+
+import pytest
+
+from engine.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError
+
+
+def fail():
+    raise RuntimeError("boom")
+
+
+def make_breaker(**kwargs):
+    options = {"window_size": 10, "min_calls": 4, "open_seconds": 0.05}
+    options.update(kwargs)
+    return CircuitBreaker("test", **options)
+
+
+def trip(breaker):
+    for _ in range(breaker.min_calls):
+        breaker.record_failure()
+    assert breaker.state == OPEN
+
+
+def test_failures_below_min_calls_keep_circuit_closed():
+    breaker = make_breaker()
+    for _ in range(3):
+        breaker.record_failure()
+    assert breaker.state == CLOSED
+
+    breaker.record_failure()
+    assert breaker.state == OPEN
+
+
+def test_opens_when_failure_rate_reaches_threshold():
+    breaker = make_breaker()
+    for _ in range(3):
+        breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CLOSED  # 1/4
+
+    breaker.record_failure()
+    assert breaker.state == CLOSED  # 2/5
+
+    breaker.record_failure()
+    assert breaker.state == OPEN  # 3/6
+
+
+def test_slow_calls_count_as_failures():
+    breaker = make_breaker(slow_call_seconds=0.01)
+    for _ in range(4):
+        assert breaker.call(time.sleep, 0.02) is None
+    assert breaker.state == OPEN
+
+
+def test_open_circuit_rejects_calls_without_running_them():
+    breaker = make_breaker(open_seconds=60.0)
+    trip(breaker)
+
+    called = []
+    with pytest.raises(CircuitOpenError) as exc_info:
+        breaker.call(called.append, 1)
+    assert called == []
+    assert exc_info.value.name == "test"
+
+
+def test_half_open_lets_one_probe_through_and_closes_on_success():
+    breaker = make_breaker()
+    trip(breaker)
+    time.sleep(0.06)
+    assert breaker.state == HALF_OPEN
+
+    assert breaker.allow_request()
+    assert not breaker.allow_request()  # 試し打ちは同時に 1 件だけ
+
+    breaker.record_success()
+    assert breaker.state == CLOSED
+    assert breaker.allow_request()
+
+
+def test_failed_probe_reopens_circuit():
+    breaker = make_breaker()
+    trip(breaker)
+    time.sleep(0.06)
+
+    with pytest.raises(RuntimeError):
+        breaker.call(fail)
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.call(fail)
+
+
+def test_closing_after_probe_starts_a_fresh_window():
+    breaker = make_breaker()
+    trip(breaker)
+    time.sleep(0.06)
+    assert breaker.call(lambda: "ok") == "ok"
+
+    # open 前の失敗は数えない（試し打ちの成功 1 件 + 失敗 2 件は min_calls 未満）
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == CLOSED
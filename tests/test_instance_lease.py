@@ -0,0 +1,170 @@
+import threading
+import time
+
+from engine.instance_lease import InstanceLease, LocalLeaseBackend
+
+
+class FlakyBackend(LocalLeaseBackend):
+    """compare_and_update だけ失敗させられるローカル保存先"""
+
+    def __init__(self):
+        super().__init__()
+        self.fail = False
+
+    def compare_and_update(self, expected_token, fields):
+        if self.fail:
+            raise RuntimeError("datastore unavailable")
+        return super().compare_and_update(expected_token, fields)
+
+
+def start_old_instance(
+    backend, ttl_seconds=10.0, sessions=None, handled_ids=None, pending_writes=None, respond=True
+):
+    """明け渡し依頼を受けたら、別スレッドで保存 → 解放する旧インスタンス"""
+    events = []
+
+    def on_handoff_requested(new_instance_id):
+        events.append(("handoff", new_instance_id))
+        if not respond:
+            return
+
+        def _drain():
+            backend.save_handoff(old.token, sessions or {}, handled_ids or [], pending_writes)
+            old.release()
+
+        threading.Thread(target=_drain).start()
+
+    old = InstanceLease(
+        backend,
+        "old",
+        ttl_seconds=ttl_seconds,
+        on_lost=lambda: events.append(("lost",)),
+        on_handoff_requested=on_handoff_requested,
+    )
+    assert old.acquire()
+    return old, events
+
+
+def test_handoff_restores_sessions_and_handled_ids():
+    backend = LocalLeaseBackend()
+    sessions = {123: {"mode": "Q2", "tone": "cool_girl"}}
+    pending_writes = {"states": {"123": {"tone": "cool_girl"}}, "logs": []}
+    old, events = start_old_instance(
+        backend, sessions=sessions, handled_ids=[30, 10, 20], pending_writes=pending_writes
+    )
+
+    new = InstanceLease(backend, "new", ttl_seconds=10.0)
+    started = time.monotonic()
+    assert new.take_over(timeout=2.0)
+    assert time.monotonic() - started < 0.4
+
+    assert events == [("handoff", "new")]
+    assert not old.is_owner()
+    assert new.is_owner()
+    assert new.token == 2
+    assert new.previous_record["released"] is True
+
+    restored, handled, restored_writes = backend.load_handoff(new.previous_record["token"])
+    assert restored == sessions
+    assert handled == {10, 20, 30}
+    assert restored_writes == pending_writes
+
+
+def test_handoff_state_from_another_generation_is_ignored():
+    backend = LocalLeaseBackend()
+    backend.save_handoff(99, {1: {"mode": "Q1"}}, [1])
+
+    assert backend.load_handoff(1) == ({}, set(), None)
+
+
+def test_take_over_after_expiry_when_old_instance_is_gone():
+    backend = LocalLeaseBackend()
+    old, events = start_old_instance(backend, ttl_seconds=0.2, respond=False)
+
+    new = InstanceLease(backend, "new", ttl_seconds=10.0)
+    assert new.take_over(timeout=2.0)
+
+    assert new.previous_record["released"] is False
+    assert ("lost",) in events
+    assert not old.is_owner()
+
+
+def test_take_over_times_out_while_holder_is_alive():
+    backend = LocalLeaseBackend()
+    old, events = start_old_instance(backend, respond=False)
+
+    new = InstanceLease(backend, "new", ttl_seconds=10.0)
+    assert not new.take_over(timeout=0.3)
+
+    assert old.is_owner()
+    assert not new.is_owner()
+    assert backend.read()["handoff_to"] == "new"
+    assert events == [("handoff", "new")]
+
+
+def test_failed_renewal_keeps_ownership():
+    backend = FlakyBackend()
+    lost = []
+    lease = InstanceLease(backend, "a", ttl_seconds=0.05, on_lost=lambda: lost.append(True))
+    assert lease.acquire()
+
+    backend.fail = True
+    time.sleep(0.1)
+    assert not lease.renew()
+
+    assert lease.is_owner()
+    assert lost == []
+
+
+def test_renewal_rejected_by_newer_token_loses_lease():
+    backend = LocalLeaseBackend()
+    lost = []
+    lease = InstanceLease(backend, "a", on_lost=lambda: lost.append(True))
+    assert lease.acquire()
+
+    # 変更通知が届かなかった場合でも、更新時に気づけること
+    lease.close()
+    backend.compare_and_update(lease.token, {"holder": "b", "token": lease.token + 1})
+
+    assert not lease.renew()
+    assert not lease.is_owner()
+    assert lost == [True]
+
+
+def test_newer_token_notification_loses_lease():
+    backend = LocalLeaseBackend()
+    lost = []
+    lease = InstanceLease(backend, "a", on_lost=lambda: lost.append(True))
+    assert lease.acquire()
+
+    backend.compare_and_update(lease.token, {"holder": "b", "token": lease.token + 1})
+
+    assert not lease.is_owner()
+    assert lost == [True]
+
+
+def test_stale_notification_is_ignored():
+    backend = LocalLeaseBackend()
+    backend.compare_and_update(None, {"holder": "x", "token": 1, "released": True})
+
+    lost = []
+    handoffs = []
+    lease = InstanceLease(
+        backend,
+        "a",
+        on_lost=lambda: lost.append(True),
+        on_handoff_requested=handoffs.append,
+    )
+    assert lease.acquire()
+    assert lease.token == 2
+
+    # 取得前の古い通知が遅れて届いても手放さない
+    lease._on_record({"holder": "x", "token": 1, "handoff_to": "b"})
+    assert lease.is_owner()
+    assert lost == []
+    assert handoffs == []
+
+    # 明け渡し依頼は 1 回だけ通知される
+    lease._on_record({"holder": "a", "token": 2, "handoff_to": "b"})
+    lease._on_record({"holder": "a", "token": 2, "handoff_to": "b"})
+    assert handoffs == ["b"]
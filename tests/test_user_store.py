@@ -0,0 +1,120 @@
+import threading
+import time
+
+from engine.circuit_breaker import CircuitBreaker
+from engine.user_store import UserStore, count_pending
+
+
+class FakeDoc:
+    def __init__(self, db, key):
+        self.db = db
+        self.key = key
+
+    def set(self, data, merge=False, timeout=None):
+        self.db.write(self.key, data)
+
+    def collection(self, name):
+        return FakeLogs(self.db, self.key)
+
+
+class FakeLogs:
+    def __init__(self, db, key):
+        self.db = db
+        self.key = key
+
+    def add(self, entry, timeout=None):
+        self.db.write(self.key, ("log", entry["reply"]))
+
+
+class FakeDB:
+    """書き込みを順に記録するだけの Firestore 代わり（fail=True で失敗させる）"""
+
+    def __init__(self):
+        self.fail = False
+        self.delays = []  # 先頭から順に、各書き込みの前に待つ秒数
+        self.writes = []
+
+    def collection(self, name):
+        return self
+
+    def document(self, key):
+        return FakeDoc(self, key)
+
+    def write(self, key, data):
+        if self.fail:
+            raise RuntimeError("firestore unavailable")
+        if self.delays:
+            time.sleep(self.delays.pop(0))
+        self.writes.append((key, data))
+
+
+def make_store(db):
+    # 障害を再現しても回路が open にならないようにする
+    return UserStore(db, CircuitBreaker("test", min_calls=10000))
+
+
+def queue_writes(store, db):
+    db.fail = True
+    store.set_user_state(1, {"tone": "cool_girl"})
+    store.set_user_state(1, {"Q1": "90分"})
+    store.add_log(1, "cool_girl", {}, "reply-1")
+    db.fail = False
+
+
+def test_drain_pending_sends_everything_past_replay_limits():
+    db = FakeDB()
+    store = make_store(db)
+    db.fail = True
+    for uid in range(120):
+        store.set_user_state(uid, {"tone": "calm_male"})
+    db.fail = False
+
+    assert not store.drain_pending(max_seconds=5.0)
+    assert len(db.writes) == 120
+    assert not store.has_pending()
+
+
+def test_concurrent_flushes_do_not_reorder_a_users_writes():
+    db = FakeDB()
+    store = make_store(db)
+    queue_writes(store, db)
+    db.delays = [0.2]
+
+    # 1 回目の再送が遅い間に積まれた差分を、2 回目の再送が追い越して書かないこと
+    first = threading.Thread(target=store.flush_pending)
+    first.start()
+    time.sleep(0.05)
+    store.set_user_state(1, {"Q2": "元気"})
+    second = threading.Thread(target=store.flush_pending)
+    second.start()
+    first.join()
+    second.join()
+    store.flush_pending()
+
+    states = [data for key, data in db.writes if not isinstance(data, tuple)]
+    assert states == [{"tone": "cool_girl", "Q1": "90分"}, {"Q2": "元気"}]
+
+
+def test_export_and_import_pending_keeps_order_and_newer_local_state():
+    old_db = FakeDB()
+    old = make_store(old_db)
+    queue_writes(old, old_db)
+
+    pending = old.export_pending()
+    assert count_pending(pending) == 2
+    assert not old.has_pending()
+
+    new_db = FakeDB()
+    new = make_store(new_db)
+    new_db.fail = True
+    new.set_user_state(1, {"tone": "calm_male"})
+    new.add_log(1, "calm_male", {}, "reply-2")
+    new_db.fail = False
+
+    new.import_pending(pending)
+    assert not new.drain_pending(max_seconds=5.0)
+    assert new_db.writes == [
+        ("1", {"tone": "calm_male", "Q1": "90分"}),
+        ("1", ("log", "reply-1")),
+        ("1", ("log", "reply-2")),
+    ]